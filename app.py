@@ -1,11 +1,14 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request
 import os
-from datetime import datetime
-import json
+import orjson
 import sqlite3
-import numpy as np
-from sklearn.ensemble import IsolationForest
+import math
+import queue
+import threading
 import re
+import string
+import time
+from functools import lru_cache
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -14,29 +17,62 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Initialize Database
-def init_db():
-    conn = sqlite3.connect('kirana_store.db')
-    c = conn.cursor()
-    
-    # Transactions table
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions
+DATABASE = 'kirana_store.db'
+
+# Timestamps are filled in by SQLite when a row is written, as UTC with a
+# trailing 'Z' so the dashboard's new Date() does not read them as local time
+TIMESTAMP_DEFAULT = "strftime('%Y-%m-%dT%H:%M:%fZ', 'now')"
+
+TRANSACTIONS_SCHEMA = f'''CREATE TABLE IF NOT EXISTS transactions
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  timestamp TEXT,
+                  timestamp TEXT DEFAULT ({TIMESTAMP_DEFAULT}),
                   item TEXT,
                   amount REAL,
                   type TEXT,
                   payment_method TEXT,
-                  customer_name TEXT)''')
-    
-    # Inventory table
-    c.execute('''CREATE TABLE IF NOT EXISTS inventory
+                  customer_name TEXT)'''
+
+INVENTORY_SCHEMA = f'''CREATE TABLE IF NOT EXISTS inventory
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   item_name TEXT UNIQUE,
                   quantity INTEGER,
                   reorder_level INTEGER,
                   unit_price REAL,
-                  last_updated TEXT)''')
+                  last_updated TEXT DEFAULT ({TIMESTAMP_DEFAULT}))'''
+
+def _migrate_timestamp_default(c, table, column, schema):
+    """
+    Rebuild a table created before its timestamp column had the UTC default.
+    Older rows hold server-local datetime.now() values without an offset;
+    SQLite's 'utc' modifier converts them from the server's local time zone
+    so the whole column is on one clock
+    """
+    columns = c.execute(f'PRAGMA table_info({table})').fetchall()
+    if any(col[1] == column and col[4] != TIMESTAMP_DEFAULT for col in columns):
+        c.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+        c.execute(schema)
+        c.execute(f'INSERT INTO {table} SELECT * FROM {table}_old')
+        c.execute(f'DROP TABLE {table}_old')
+        c.execute(f'''UPDATE {table}
+                      SET {column} = strftime('%Y-%m-%dT%H:%M:%fZ', {column}, 'utc')
+                      WHERE {column} NOT LIKE '%Z' ''')
+
+# Initialize Database
+def init_db():
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+    
+    # WAL lets dashboard reads run alongside process-input writes; the mode is
+    # stored in the database file, so it only needs setting once
+    c.execute('PRAGMA journal_mode=WAL')
+    
+    # Transactions table
+    c.execute(TRANSACTIONS_SCHEMA)
+    _migrate_timestamp_default(c, 'transactions', 'timestamp', TRANSACTIONS_SCHEMA)
+    
+    # Inventory table
+    c.execute(INVENTORY_SCHEMA)
+    _migrate_timestamp_default(c, 'inventory', 'last_updated', INVENTORY_SCHEMA)
     
     # Alerts table
     c.execute('''CREATE TABLE IF NOT EXISTS alerts
@@ -46,40 +82,245 @@ def init_db():
                   message TEXT,
                   status TEXT)''')
     
+    # Running sale statistics for fraud detection (single row holding the
+    # Welford count, mean and sum of squared deviations, updated with every
+    # sale insert); seeded from any existing history
+    c.execute('''CREATE TABLE IF NOT EXISTS sale_stats
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                  n INTEGER,
+                  mean REAL,
+                  m2 REAL)''')
+    c.execute('''WITH sales AS (SELECT amount FROM transactions WHERE type = 'sale'),
+                      agg AS (SELECT COUNT(*) AS n, COALESCE(AVG(amount), 0.0) AS mean FROM sales)
+                 INSERT OR IGNORE INTO sale_stats (id, n, mean, m2)
+                 SELECT 1, n, mean,
+                        COALESCE((SELECT SUM((amount - mean) * (amount - mean)) FROM sales), 0.0)
+                 FROM agg''')
+    
+    # Indexes for the agent queries (inventory.item_name is already
+    # indexed through its UNIQUE constraint)
+    c.execute('DROP INDEX IF EXISTS idx_tx_type_ts')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_tx_ts
+                 ON transactions(timestamp)''')
+    # Covers the low-stock filter and its projected columns (replaces the
+    # narrower idx_inv_low)
+    c.execute('DROP INDEX IF EXISTS idx_inv_low')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_inv_reorder
+                 ON inventory(quantity, reorder_level, item_name)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_inv_updated
+                 ON inventory(last_updated)''')
+    
     conn.commit()
     conn.close()
 
 init_db()
 
+# ===== DATABASE CONNECTION =====
+def connect_db():
+    """
+    Open a tuned connection to the store database
+    """
+    # Autocommit mode: writes open their own BEGIN IMMEDIATE. The default
+    # statement cache (128) holds every app query, and because connections
+    # persist per thread those statements stay prepared across requests
+    conn = sqlite3.connect(DATABASE, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
+
+# One connection per worker thread, kept open across requests
+_local = threading.local()
+
+def get_db():
+    """
+    Return the current thread's connection, opening it on first use
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = connect_db()
+    return conn
+
+# ===== BACKGROUND WRITER =====
+# SQLite admits one writer at a time, so all transaction writes go through a
+# single thread that commits whatever has queued up within a short window
+WRITE_BATCH_SIZE = 50
+WRITE_BATCH_WINDOW = 0.02  # seconds
+WRITE_TIMEOUT = 10  # seconds a request waits for its commit
+
+_write_queue = queue.Queue()
+# Guards each record's 'state': 'queued' until the writer claims it, or
+# 'cancelled' if its request timed out first (the writer then skips it)
+_write_state_lock = threading.Lock()
+
+def _apply_inventory(c, record):
+    """
+    Update stock (and sale statistics) for one queued transaction
+    """
+    txn = record['txn']
+    if txn['type'] == 'sale':
+        c.execute('''UPDATE inventory SET quantity = quantity - ? 
+                     WHERE item_name = ?''',
+                  (txn['quantity'], txn['item']))
+        # Welford update; every right-hand side sees the old row values
+        c.execute('''UPDATE sale_stats SET
+                         n = n + 1,
+                         mean = mean + (:x - mean) / (n + 1),
+                         m2 = m2 + (:x - mean) * (:x - mean - (:x - mean) / (n + 1))
+                     WHERE id = 1''',
+                  {'x': txn['amount']})
+    else:
+        c.execute('''INSERT INTO inventory 
+                     (item_name, quantity, reorder_level, unit_price)
+                     VALUES (?, ?, 10, ?)
+                     ON CONFLICT(item_name) DO UPDATE SET
+                         quantity = quantity + excluded.quantity,
+                         unit_price = excluded.unit_price,
+                         last_updated = excluded.last_updated''',
+                  (txn['item'], txn['quantity'],
+                   txn['amount'] / txn['quantity']))
+
+def _write_batch(conn, batch):
+    """
+    Write a batch of queued transactions in one BEGIN IMMEDIATE/COMMIT
+    """
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.executemany('''INSERT INTO transactions 
+                         (item, amount, type, payment_method, customer_name)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      [(r['txn']['item'], r['txn']['amount'],
+                        r['txn']['type'], r['txn']['payment_method'], 'Customer')
+                       for r in batch])
+        
+        # Inventory changes are applied in arrival order
+        for record in batch:
+            _apply_inventory(c, record)
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def _writer_loop():
+    conn = None
+    while True:
+        batch = [_write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW
+        while len(batch) < WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        # Drop records whose requests already gave up; the rest can no
+        # longer be cancelled
+        with _write_state_lock:
+            batch = [record for record in batch if record['state'] != 'cancelled']
+            for record in batch:
+                record['state'] = 'claimed'
+        if not batch:
+            continue
+        
+        try:
+            if conn is None:
+                conn = connect_db()
+            _write_batch(conn, batch)
+        except Exception as batch_error:
+            if conn is None or isinstance(batch_error, sqlite3.OperationalError):
+                # Could not open the database, or it is locked/unavailable;
+                # retrying record by record would only wait out the busy
+                # timeout again for each one
+                for record in batch:
+                    record['error'] = batch_error
+            else:
+                # Retry one at a time so a bad record only fails its own request
+                for record in batch:
+                    try:
+                        _write_batch(conn, [record])
+                    except Exception as e:
+                        record['error'] = e
+                # Nothing got through; reopen the connection for the next batch
+                if all(record['error'] is not None for record in batch):
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                    conn = None
+        finally:
+            for record in batch:
+                record['done'].set()
+
+def queue_transaction(txn):
+    """
+    Hand a parsed transaction to the writer and wait until it is committed
+    """
+    record = {
+        'txn': txn,
+        'done': threading.Event(),
+        'error': None,
+        'state': 'queued'
+    }
+    _write_queue.put(record)
+    if not record['done'].wait(timeout=WRITE_TIMEOUT):
+        with _write_state_lock:
+            if record['state'] == 'queued':
+                # Not written and never will be, so the client can retry
+                record['state'] = 'cancelled'
+                raise RuntimeError('Timed out waiting for the database write')
+        # Already claimed by the writer; its batch finishes within the
+        # SQLite busy timeout, so wait for the real outcome
+        record['done'].wait()
+    if record['error'] is not None:
+        raise record['error']
+
+threading.Thread(target=_writer_loop, name='db-writer', daemon=True).start()
+
 # ===== NLP PARSER =====
+# Amount and quantity in one scan. The alternation sits inside a lookahead so
+# nothing is consumed and the two fields can share digits ('rs 5 kg'); each
+# branch has one named group, reported as match.lastgroup. The branches cannot
+# match at the same position, so the first hit per field is the same as a
+# separate leftmost search would find
+TXN_RE = re.compile(
+    r'(?=(?:rs\.?|rupees?|₹)\s*(?P<amount>\d+(?:\.\d{2})?)'
+    r'|(?P<amount_suffix>\d+(?:\.\d{2})?)\s*(?:rs\.?|rupees?|₹)'
+    r'|(?P<quantity>\d+)\s*(?:kg|kg\.|kilos?|packets?|units?|pieces?))'
+)
+
+# Token prefixes marking a purchase ('buying', 'purchases', 'bought2kg', ...)
+PURCHASE_STEMS = ('buy', 'bought', 'purchas', 'supplier')
+ITEMS = ['rice', 'wheat', 'sugar', 'oil', 'dal', 'tea', 'salt', 'milk', 'biscuit']
+# Token -> item name, accepting simple plurals ('biscuits')
+ITEM_TOKENS = {**{i: i for i in ITEMS}, **{i + 's': i for i in ITEMS}}
+# Punctuation becomes whitespace so 'rice,' tokenizes as 'rice'
+TOKEN_TABLE = str.maketrans({ch: ' ' for ch in string.punctuation})
+
 def parse_transaction_text(text):
     """
     Extract transaction details from text using regex patterns
     """
     text = text.lower()
     
-    # Extract amount
-    amount_pattern = r'(?:rs\.?|rupees?|₹)\s*(\d+(?:\.\d{2})?)|(\d+(?:\.\d{2})?)\s*(?:rs\.?|rupees?|₹)'
-    amount_match = re.search(amount_pattern, text)
-    amount = float(amount_match.group(1) or amount_match.group(2)) if amount_match else 0.0
-    
-    # Detect transaction type
-    transaction_type = 'sale'
-    if any(word in text for word in ['buy', 'purchase', 'bought', 'supplier']):
-        transaction_type = 'purchase'
-    
-    # Extract item (simplified - look for common items)
-    items = ['rice', 'wheat', 'sugar', 'oil', 'dal', 'tea', 'salt', 'milk', 'biscuit']
-    item = 'general'
-    for i in items:
-        if i in text:
-            item = i
+    # Keep the first hit for each field ('amount_suffix' counts as 'amount')
+    hits = {}
+    for match in TXN_RE.finditer(text):
+        hits.setdefault(match.lastgroup.split('_')[0], match.group(match.lastgroup))
+        if len(hits) == 2:
             break
     
-    # Extract quantity
-    quantity_pattern = r'(\d+)\s*(?:kg|kg\.|kilos?|packets?|units?|pieces?)'
-    quantity_match = re.search(quantity_pattern, text)
-    quantity = int(quantity_match.group(1)) if quantity_match else 1
+    amount = float(hits['amount']) if 'amount' in hits else 0.0
+    quantity = int(hits['quantity']) if 'quantity' in hits else 1
+    
+    # Type comes from token prefixes, item from a hashed token lookup
+    tokens = text.translate(TOKEN_TABLE).split()
+    transaction_type = 'purchase' if any(t.startswith(PURCHASE_STEMS) for t in tokens) else 'sale'
+    item = next((ITEM_TOKENS[t] for t in tokens if t in ITEM_TOKENS), 'general')
     
     return {
         'item': item,
@@ -94,21 +335,21 @@ def cash_flow_forecast():
     """
     Predict if cash shortage is likely in next 7 days
     """
-    conn = sqlite3.connect('kirana_store.db')
+    conn = get_db()
     c = conn.cursor()
     
-    # Get last 30 days transactions
-    c.execute('''SELECT amount, type FROM transactions 
-                 WHERE timestamp >= date('now', '-30 days')''')
-    transactions = c.fetchall()
-    conn.close()
+    # Totals per type over the last 30 days
+    c.execute('''SELECT type, SUM(amount) FROM transactions 
+                 WHERE timestamp >= date('now', '-30 days')
+                 GROUP BY type''')
+    totals = dict(c.fetchall())
     
-    if not transactions:
+    if not totals:
         return {'shortage_predicted': False, 'recommendation': 'Insufficient data'}
     
     # Calculate daily cash flow
-    sales = sum([t[0] for t in transactions if t[1] == 'sale'])
-    purchases = sum([t[0] for t in transactions if t[1] == 'purchase'])
+    sales = totals.get('sale', 0.0)
+    purchases = totals.get('purchase', 0.0)
     net_flow = sales - purchases
     daily_avg = net_flow / 30
     
@@ -130,14 +371,13 @@ def inventory_alert():
     """
     Check for low stock items
     """
-    conn = sqlite3.connect('kirana_store.db')
+    conn = get_db()
     c = conn.cursor()
     
     c.execute('''SELECT item_name, quantity, reorder_level 
                  FROM inventory 
                  WHERE quantity <= reorder_level''')
     low_stock_items = c.fetchall()
-    conn.close()
     
     stock_low = len(low_stock_items) > 0
     
@@ -154,19 +394,17 @@ def fraud_detection(transaction_amount):
     """
     Detect if current transaction is anomalous
     """
-    conn = sqlite3.connect('kirana_store.db')
+    conn = get_db()
     c = conn.cursor()
     
-    c.execute('SELECT amount FROM transactions WHERE type = "sale"')
-    amounts = [row[0] for row in c.fetchall()]
-    conn.close()
+    c.execute('SELECT n, mean, m2 FROM sale_stats WHERE id = 1')
+    n, mean_amount, m2 = c.fetchone()
     
-    if len(amounts) < 10:
+    if n < 10:
         return {'fraud_suspected': False, 'reason': 'Insufficient data'}
     
-    # Statistical anomaly detection
-    mean_amount = np.mean(amounts)
-    std_amount = np.std(amounts)
+    # Statistical anomaly detection (population std)
+    std_amount = math.sqrt(m2 / n)
     
     # Flag if transaction is > 3 standard deviations
     threshold = mean_amount + (3 * std_amount)
@@ -179,7 +417,23 @@ def fraud_detection(transaction_amount):
         'reason': reason if fraud_suspected else 'Transaction within normal range'
     }
 
+# ===== AGENT RESULT CACHE =====
+AGENT_CACHE_SECONDS = 60
+
+def _cache_bucket():
+    return int(time.time() // AGENT_CACHE_SECONDS)
+
+@lru_cache(maxsize=1)
+def _cf_cached(bucket):
+    return cash_flow_forecast()
+
 # ===== ROUTES =====
+def json_response(obj, status=200):
+    """
+    Serialize a response body with orjson instead of Flask's jsonify
+    """
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -190,45 +444,22 @@ def process_input():
     Main endpoint to process voice/text input
     """
     try:
-        data = request.json
+        data = orjson.loads(request.get_data())
         input_text = data.get('text', '')
         
         if not input_text:
-            return jsonify({'error': 'No input provided'}), 400
+            return json_response({'error': 'No input provided'}, 400)
         
         # Parse transaction
         parsed_data = parse_transaction_text(input_text)
         
-        # Store in database
-        conn = sqlite3.connect('kirana_store.db')
-        c = conn.cursor()
-        
-        timestamp = datetime.now().isoformat()
-        c.execute('''INSERT INTO transactions 
-                     (timestamp, item, amount, type, payment_method, customer_name)
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (timestamp, parsed_data['item'], parsed_data['amount'], 
-                   parsed_data['type'], parsed_data['payment_method'], 'Customer'))
+        # Store in database; returns once committed so the agents below
+        # see this transaction
+        queue_transaction(parsed_data)
         
-        # Update inventory
-        if parsed_data['type'] == 'sale':
-            c.execute('''UPDATE inventory SET quantity = quantity - ? 
-                         WHERE item_name = ?''',
-                      (parsed_data['quantity'], parsed_data['item']))
-        else:
-            c.execute('''INSERT OR REPLACE INTO inventory 
-                         (item_name, quantity, reorder_level, unit_price, last_updated)
-                         VALUES (?, 
-                                 COALESCE((SELECT quantity FROM inventory WHERE item_name = ?), 0) + ?,
-                                 10, ?, ?)''',
-                      (parsed_data['item'], parsed_data['item'], parsed_data['quantity'],
-                       parsed_data['amount'] / parsed_data['quantity'], timestamp))
-        
-        conn.commit()
-        conn.close()
-        
-        # Run AI agents
-        cf_result = cash_flow_forecast()
+        # Run AI agents; the cash-flow trend may lag by up to
+        # AGENT_CACHE_SECONDS, stock levels are always read fresh
+        cf_result = _cf_cached(_cache_bucket())
         inv_result = inventory_alert()
         fraud_result = fraud_detection(parsed_data['amount'])
         
@@ -257,7 +488,7 @@ def process_input():
                 'severity': 'critical'
             })
         
-        return jsonify({
+        return json_response({
             'success': True,
             'parsed_transaction': parsed_data,
             'agents': {
@@ -269,26 +500,30 @@ def process_input():
         })
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/dashboard')
 def dashboard():
     """
-    Get dashboard data
+    Get dashboard data; inventory is paged with ?limit=&offset=
     """
-    conn = sqlite3.connect('kirana_store.db')
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    
+    conn = get_db()
     c = conn.cursor()
     
     # Recent transactions
     c.execute('''SELECT * FROM transactions 
                  ORDER BY timestamp DESC LIMIT 10''')
-    transactions = [dict(zip([col[0] for col in c.description], row)) 
-                   for row in c.fetchall()]
+    transactions = [dict(row) for row in c.fetchall()]
     
-    # Inventory status
-    c.execute('SELECT * FROM inventory')
-    inventory = [dict(zip([col[0] for col in c.description], row)) 
-                for row in c.fetchall()]
+    # Inventory status, most recently updated first
+    c.execute('''SELECT item_name, quantity, reorder_level, unit_price
+                 FROM inventory
+                 ORDER BY last_updated DESC LIMIT ? OFFSET ?''',
+              (limit, offset))
+    inventory = [dict(row) for row in c.fetchall()]
     
     # Summary stats
     c.execute('''SELECT 
@@ -297,11 +532,9 @@ def dashboard():
                     COUNT(*) as transaction_count
                  FROM transactions
                  WHERE date(timestamp) = date('now')''')
-    stats = dict(zip([col[0] for col in c.description], c.fetchone()))
-    
-    conn.close()
+    stats = dict(c.fetchone())
     
-    return jsonify({
+    return json_response({
         'transactions': transactions,
         'inventory': inventory,
         'stats': stats